@@ -1,21 +1,52 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request, Security
+from fastapi import FastAPI, Depends, HTTPException, Query, status, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm, APIKeyHeader
-from pydantic import BaseModel
-from typing import List, Optional, Union
-from passlib.context import CryptContext
+from fastapi.responses import StreamingResponse
+from fastapi.openapi.utils import get_openapi
+from fastapi.routing import APIRoute
+from fastapi.security import OAuth2PasswordRequestForm
+from pydantic import BaseModel, ConfigDict, TypeAdapter
+from typing import List, NamedTuple, Optional, Tuple, Union
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 from enum import Enum
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, Boolean, DateTime, LargeBinary, Index, or_, select, bindparam
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.orm import sessionmaker, relationship, Session
+from sqlalchemy.sql import func
+from cachetools import TTLCache
+from jwt.utils import base64url_decode
 import jwt as pyjwt
-import secrets
+import asyncio
+import base64
+import bcrypt
+import binascii
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
 
 # Database setup
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _):
+    # WAL lets readers proceed while the log writer commits
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA cache_size=-65536")
+    cur.close()
 Base = declarative_base()
 
 # Security settings
@@ -23,16 +54,40 @@ SECRET_KEY = "secret"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 API_KEY_NAME = "X-API-Key"
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
-api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
+LOGS_LIMIT = 500
+LOGS_PAGE_SIZE = 200
+LOGS_EXPORT_CHUNK = 1000
+
+# argon2id (OWASP 46 MiB profile); bcrypt kept so existing hashes still verify
+argon2_hasher = PasswordHasher(time_cost=2, memory_cost=46 * 1024, parallelism=1)
+# Documented in OpenAPI only (see custom_openapi); _auth_header does the actual parsing
+SECURITY_SCHEMES = {
+    "OAuth2PasswordBearer": {"type": "oauth2", "flows": {"password": {"scopes": {}, "tokenUrl": "/token"}}},
+    "APIKeyHeader": {"type": "apiKey", "in": "header", "name": API_KEY_NAME},
+}
+
+# HS256 keyed once; each verify copies this instead of re-keying SHA-256
+_hmac_template = hmac.new(SECRET_KEY.encode(), digestmod=hashlib.sha256)
+
+# Decoded JWT payloads keyed by raw token
+_jwt_cache = TTLCache(maxsize=10000, ttl=30)
+_jwt_cache_lock = threading.Lock()
+
+# Resolved users keyed by raw token as (exp, CurrentUser); cleared on any admin user change
+_user_cache = TTLCache(maxsize=10000, ttl=30)
+_user_cache_lock = threading.Lock()
+# Bumped by invalidate_user_cache; a lookup that started before a bump must not be cached
+_user_cache_generation = 0
+# Users resolved by API key, keyed by the key's SHA-256; same 30s bound, lock and invalidation as above
+_api_key_user_cache = TTLCache(maxsize=10000, ttl=30)
 
 # Role Enum
 class Role(str, Enum):
     ADMIN = "admin"
     USER = "user"
 
+_ADMIN = Role.ADMIN.value
+
 # Database Models
 class UserDB(Base):
     __tablename__ = "users"
@@ -44,6 +99,16 @@ class UserDB(Base):
     role = Column(String)
     is_active = Column(Boolean, default=True)
     api_key = Column(String, unique=True, index=True, nullable=True)
+    api_key_hash = Column(LargeBinary(32), unique=True, index=True, nullable=True)
+    # lazy="raise": any access must be eager-loaded explicitly, so N+1 loads fail loudly
+    notes = relationship(
+        "NoteDB", primaryjoin="UserDB.username == foreign(NoteDB.owner)",
+        back_populates="owner_user", lazy="raise", viewonly=True,
+    )
+    logs = relationship(
+        "LogDB", primaryjoin="UserDB.username == foreign(LogDB.username)",
+        back_populates="user", lazy="raise", viewonly=True,
+    )
 
 class NoteDB(Base):
     __tablename__ = "notes"
@@ -52,20 +117,72 @@ class NoteDB(Base):
     content = Column(String)
     owner = Column(String)
     is_private = Column(Boolean, default=True)
+    owner_user = relationship(
+        "UserDB", primaryjoin="foreign(NoteDB.owner) == UserDB.username",
+        back_populates="notes", lazy="raise", viewonly=True,
+    )
+    __table_args__ = (Index("ix_notes_owner_private", "owner", "is_private"),)
 
 class LogDB(Base):
     __tablename__ = "logs"
     id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    # Stamped by SQLite; default also covers logs tables created before server_default
+    timestamp = Column(
+        DateTime, server_default=func.current_timestamp(), default=func.current_timestamp(), index=True
+    )
     username = Column(String)
     endpoint = Column(String)
     method = Column(String)
     status_code = Column(Integer)
+    user = relationship(
+        "UserDB", primaryjoin="foreign(LogDB.username) == UserDB.username",
+        back_populates="logs", lazy="raise", viewonly=True,
+    )
 
 Base.metadata.create_all(bind=engine)
 
+def hash_api_key(api_key: str) -> bytes:
+    return hashlib.sha256(api_key.encode()).digest()
+
+def _upgrade_schema():
+    # Databases created before api_key_hash and the newer indexes existed are brought up to date here
+    if "api_key_hash" not in {c["name"] for c in inspect(engine).get_columns("users")}:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE users ADD COLUMN api_key_hash BLOB"))
+            conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_users_api_key_hash ON users (api_key_hash)"))
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_logs_timestamp ON logs (timestamp)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_notes_owner_private ON notes (owner, is_private)"))
+    db = SessionLocal()
+    try:
+        for user in db.query(UserDB).filter(UserDB.api_key_hash.is_(None), UserDB.api_key.isnot(None)):
+            user.api_key_hash = hash_api_key(user.api_key)
+        db.commit()
+    finally:
+        db.close()
+
+_upgrade_schema()
+
+# Core statements for read-only paths, built once so the compiled cache always hits
+class CurrentUser(NamedTuple):
+    id: int
+    username: str
+    role: str
+    is_active: bool
+
+_current_user_columns = (UserDB.id, UserDB.username, UserDB.role, UserDB.is_active)
+user_by_username_stmt = select(*_current_user_columns).where(UserDB.username == bindparam("username"))
+user_by_api_key_stmt = select(*_current_user_columns).where(UserDB.api_key_hash == bindparam("api_key_hash"))
+notes_stmt = select(NoteDB.id, NoteDB.title, NoteDB.content, NoteDB.owner, NoteDB.is_private)
+logs_stmt = select(
+    LogDB.id, LogDB.timestamp, LogDB.username, LogDB.endpoint, LogDB.method, LogDB.status_code
+).order_by(LogDB.id.desc())
+users_stmt = select(UserDB.username, UserDB.full_name, UserDB.email, UserDB.role, UserDB.is_active)
+
 # Pydantic Models
 class User(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     username: str
     full_name: str
     email: str
@@ -74,6 +191,15 @@ class User(BaseModel):
     is_active: bool
     api_key: Optional[str] = None
 
+class UserSummary(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    username: str
+    full_name: str
+    email: str
+    role: Role
+    is_active: bool
+
 class UserCreate(BaseModel):
     username: str
     full_name: str
@@ -95,6 +221,8 @@ class NoteUpdate(BaseModel):
     is_private: Optional[bool] = None
 
 class Note(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     title: str
     content: str
@@ -102,6 +230,8 @@ class Note(BaseModel):
     is_private: bool
 
 class Log(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     timestamp: datetime
     username: Optional[str]
@@ -109,12 +239,43 @@ class Log(BaseModel):
     method: str
     status_code: int
 
+# Adapters for list responses: rows are validated and dumped by pydantic-core in one pass
+_notes_adapter = TypeAdapter(List[Note])
+_logs_adapter = TypeAdapter(List[Log])
+_users_adapter = TypeAdapter(List[UserSummary])
+
+def list_response(adapter: TypeAdapter, rows) -> Response:
+    return Response(adapter.dump_json(adapter.validate_python(rows)), media_type="application/json")
+
 # Utilities
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    # Returns (verified, new_hash); new_hash is set when a legacy hash should be upgraded
+    if hashed_password.startswith("$argon2"):
+        try:
+            argon2_hasher.verify(hashed_password, plain_password)
+        except (VerificationError, InvalidHashError):
+            return False, None
+        if argon2_hasher.check_needs_rehash(hashed_password):
+            return True, get_password_hash(plain_password)
+        return True, None
+    try:
+        verified = bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+    except ValueError:
+        return False, None
+    return verified, get_password_hash(plain_password) if verified else None
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return argon2_hasher.hash(password)
+
+# Slow password hashing gets its own small pool so a burst of logins
+# cannot exhaust the threadpool that serves every other sync route
+_pw_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="pwhash")
+
+async def run_password_hashing(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_pw_pool, func, *args)
+
+# Verified against when the username is unknown, so both login paths cost one hash
+_DUMMY_HASH = get_password_hash("x")
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -126,8 +287,79 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = pyjwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def _jwt_decode(token: str) -> dict:
+    # Minimal HS256 decode for the tokens issued by create_access_token (sub + exp)
+    try:
+        signing_input, _, crypto_segment = token.rpartition(".")
+        header_segment, _, payload_segment = signing_input.partition(".")
+        header = json.loads(base64url_decode(header_segment))
+        signature = base64url_decode(crypto_segment)
+    except (ValueError, binascii.Error) as exc:
+        raise pyjwt.DecodeError("Invalid token") from exc
+    if not isinstance(header, dict) or header.get("alg") != ALGORITHM:
+        raise pyjwt.InvalidAlgorithmError("The specified alg value is not allowed")
+    mac = _hmac_template.copy()
+    mac.update(signing_input.encode())
+    if not hmac.compare_digest(mac.digest(), signature):
+        raise pyjwt.InvalidSignatureError("Signature verification failed")
+    try:
+        payload = json.loads(base64url_decode(payload_segment))
+    except (ValueError, binascii.Error) as exc:
+        raise pyjwt.DecodeError("Invalid payload") from exc
+    if not isinstance(payload, dict):
+        raise pyjwt.DecodeError("Invalid payload")
+    if "exp" in payload:
+        if not isinstance(payload["exp"], (int, float)):
+            raise pyjwt.DecodeError("Expiration Time claim (exp) must be a number")
+        if payload["exp"] <= time.time():
+            raise pyjwt.ExpiredSignatureError("Signature has expired")
+    return payload
+
+def _cached_user(token: str):
+    with _user_cache_lock:
+        entry = _user_cache.get(token)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    return None
+
+def _cache_user(token: str, payload: dict, user, generation: int):
+    with _user_cache_lock:
+        if generation == _user_cache_generation:
+            _user_cache[token] = (payload.get("exp", 0), user)
+
+def invalidate_user_cache():
+    global _user_cache_generation
+    with _user_cache_lock:
+        _user_cache_generation += 1
+        _user_cache.clear()
+        _api_key_user_cache.clear()
+
+def _decode_cached(token: str) -> dict:
+    with _jwt_cache_lock:
+        payload = _jwt_cache.get(token)
+    # Never serve a cached payload past the token's own expiry
+    if payload is not None and payload.get("exp", 0) > time.time():
+        return payload
+    payload = _jwt_decode(token)
+    with _jwt_cache_lock:
+        _jwt_cache[token] = payload
+    return payload
+
+# Random bytes for API keys, refilled with one os.urandom call per API_KEY_POOL_SIZE bytes
+API_KEY_BYTES = 32
+API_KEY_POOL_SIZE = 4096
+_rnd_pool = bytearray()
+_rnd_lock = threading.Lock()
+# A forked worker must never hand out the same bytes as its parent
+os.register_at_fork(after_in_child=_rnd_pool.clear)
+
 def generate_api_key():
-    return secrets.token_urlsafe(32)
+    with _rnd_lock:
+        if len(_rnd_pool) < API_KEY_BYTES:
+            _rnd_pool.extend(os.urandom(API_KEY_POOL_SIZE))
+        key = bytes(_rnd_pool[:API_KEY_BYTES])
+        del _rnd_pool[:API_KEY_BYTES]
+    return base64.urlsafe_b64encode(key).rstrip(b"=").decode()
 
 # Dependency
 def get_db():
@@ -137,22 +369,45 @@ def get_db():
     finally:
         db.close()
 
-def get_current_user(token: Optional[str] = Depends(oauth2_scheme), api_key: Optional[str] = Security(api_key_header), db: Session = Depends(get_db)):
+async def _auth_header(request: Request) -> Tuple[str, str]:
+    # Single resolver: "Bearer <jwt>", then "Authorization: ApiKey <key>", then X-API-Key
+    headers = request.headers
+    scheme, _, value = headers.get("authorization", "").partition(" ")
+    scheme, value = scheme.lower(), value.strip()
+    if value and scheme in ("bearer", "apikey"):
+        return scheme, value
+    api_key = headers.get(API_KEY_NAME)
+    if api_key:
+        return "apikey", api_key
+    return "", ""
+
+def get_current_user(request: Request, credentials: Tuple[str, str] = Depends(_auth_header), db: Session = Depends(get_db)):
+    kind, value = credentials
+    token = value if kind == "bearer" else None
+    api_key = value if kind == "apikey" else None
     if token:
+        user = _cached_user(token)
+        if user is not None:
+            request.state.username = user.username
+            return user
         try:
-            payload = pyjwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            payload = _decode_cached(token)
             username: str = payload.get("sub")
             if username is None:
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Invalid authentication credentials",
                 )
-            user = db.query(UserDB).filter(UserDB.username == username).first()
+            generation = _user_cache_generation
+            row = db.execute(user_by_username_stmt, {"username": username}).first()
+            user = CurrentUser(*row) if row else None
             if user is None or not user.is_active:
                 raise HTTPException(
                     status_code=status.HTTP_401_UNAUTHORIZED,
                     detail="Invalid authentication credentials",
                 )
+            _cache_user(token, payload, user, generation)
+            request.state.username = user.username
             return user
         except pyjwt.ExpiredSignatureError:
             raise HTTPException(
@@ -165,11 +420,21 @@ def get_current_user(token: Optional[str] = Depends(oauth2_scheme), api_key: Opt
                 detail="Invalid authentication credentials",
             )
     elif api_key:
-        user = db.query(UserDB).filter(UserDB.api_key == api_key).first()
-        if not user or not user.is_active:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN, detail="Could not validate API key"
-            )
+        key_hash = hash_api_key(api_key)
+        with _user_cache_lock:
+            user = _api_key_user_cache.get(key_hash)
+        if user is None:
+            generation = _user_cache_generation
+            row = db.execute(user_by_api_key_stmt, {"api_key_hash": key_hash}).first()
+            user = CurrentUser(*row) if row else None
+            if not user or not user.is_active:
+                raise HTTPException(
+                    status_code=status.HTTP_403_FORBIDDEN, detail="Could not validate API key"
+                )
+            with _user_cache_lock:
+                if generation == _user_cache_generation:
+                    _api_key_user_cache[key_hash] = user
+        request.state.username = user.username
         return user
     else:
         raise HTTPException(
@@ -177,18 +442,86 @@ def get_current_user(token: Optional[str] = Depends(oauth2_scheme), api_key: Opt
             detail="No authentication credentials provided",
         )
 
+def require_admin(current_user: CurrentUser = Depends(get_current_user)):
+    if current_user.role != _ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
+    return current_user
+
 # Logging Function
-def log_activity(request: Request, response_status: int, db: Session, username: Optional[str] = None):
-    log_entry = LogDB(
-        username=username,
-        endpoint=request.url.path,
-        method=request.method,
-        status_code=response_status
-    )
-    db.add(log_entry)
-    db.commit()
+LOG_BATCH_SIZE = 200
+LOG_FLUSH_INTERVAL = 0.2
+LOG_QUEUE_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+async def log_activity(request: Request, response_status: int, username: Optional[str] = None):
+    # The queue lives on app.state and only exists while the drainer is running
+    log_q: Optional[asyncio.Queue] = getattr(request.app.state, "log_q", None)
+    entry = {
+        "username": username,
+        "endpoint": request.url.path,
+        "method": request.method,
+        "status_code": response_status,
+    }
+    if log_q is None:
+        # No lifespan (e.g. --lifespan off): write the row directly, as before batching
+        await run_in_threadpool(write_logs, [entry])
+        return
+    try:
+        log_q.put_nowait(entry)
+    except asyncio.QueueFull:
+        logger.warning("Log queue full; dropping log entry for %s", entry["endpoint"])
 
-app = FastAPI(title="Notes API", version="1.0.0")
+def write_logs(batch: List[dict]):
+    db = SessionLocal()
+    try:
+        db.bulk_insert_mappings(LogDB, batch)
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("Failed to write %d log entries", len(batch))
+    finally:
+        db.close()
+
+def _drain_pending(log_q: asyncio.Queue, batch: List[dict]):
+    while not log_q.empty():
+        batch.append(log_q.get_nowait())
+    if batch:
+        write_logs(batch)
+
+async def _log_drainer(log_q: asyncio.Queue):
+    batch: List[dict] = []
+    try:
+        while True:
+            batch.append(await log_q.get())
+            try:
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(await asyncio.wait_for(log_q.get(), timeout=LOG_FLUSH_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+            pending, batch = batch, []
+            await run_in_threadpool(write_logs, pending)
+    except asyncio.CancelledError:
+        _drain_pending(log_q, batch)
+        raise
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Created here so the queue belongs to the loop that serves requests
+    log_q = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+    app.state.log_q = log_q
+    log_drainer = asyncio.create_task(_log_drainer(log_q))
+    try:
+        yield
+    finally:
+        app.state.log_q = None
+        log_drainer.cancel()
+        try:
+            await log_drainer
+        except asyncio.CancelledError:
+            pass
+
+app = FastAPI(title="Notes API", version="1.0.0", lifespan=lifespan)
 
 # Add CORS middleware to allow frontend requests
 origins = [
@@ -209,25 +542,21 @@ app.add_middleware(
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     response = await call_next(request)
-    username = None
-    token = request.headers.get("authorization")
-    if token:
-        token = token.replace("Bearer ", "")
-        try:
-            payload = pyjwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-            username = payload.get("sub")
-        except pyjwt.InvalidTokenError:
-            pass
-    db = SessionLocal()
-    log_activity(request, response.status_code, db, username)
-    db.close()
+    # Set by get_current_user; unauthenticated endpoints log no username
+    username = getattr(request.state, "username", None)
+    await log_activity(request, response.status_code, username)
     return response
 
+def _save_user(db: Session, user: UserDB):
+    db.add(user)
+    db.commit()
+    db.refresh(user)
+
 @app.post("/register", response_model=User)
-def register_user(user: UserCreate, db: Session = Depends(get_db)):
-    if db.query(UserDB).filter(UserDB.username == user.username).first():
+async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+    if await run_in_threadpool(db.query(UserDB).filter(UserDB.username == user.username).first):
         raise HTTPException(status_code=400, detail="User already exists")
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await run_password_hashing(get_password_hash, user.password)
     api_key = generate_api_key()
     new_user = UserDB(
         username=user.username,
@@ -235,29 +564,40 @@ def register_user(user: UserCreate, db: Session = Depends(get_db)):
         email=user.email,
         hashed_password=hashed_password,
         role=user.role.value,
-        api_key=api_key
+        api_key=api_key,
+        api_key_hash=hash_api_key(api_key)
     )
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await run_in_threadpool(_save_user, db, new_user)
     return new_user
 
 @app.post("/token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(UserDB).filter(UserDB.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = await run_in_threadpool(db.query(UserDB).filter(UserDB.username == form_data.username).first)
+    if user is None:
+        await run_password_hashing(verify_password, form_data.password, _DUMMY_HASH)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+        )
+    verified, new_hash = await run_password_hashing(verify_password, form_data.password, user.hashed_password)
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
         )
+    # Read before committing: expire_on_commit would reload them on the event loop
+    username, api_key = user.username, user.api_key
+    if new_hash:
+        user.hashed_password = new_hash
+        await run_in_threadpool(db.commit)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": username}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer", "api_key": user.api_key}
+    return {"access_token": access_token, "token_type": "bearer", "api_key": api_key}
 
 @app.post("/notes", response_model=Note)
-def create_note(note: NoteCreate, current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
+def create_note(note: NoteCreate, current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
     new_note = NoteDB(
         title=note.title,
         content=note.content,
@@ -270,31 +610,29 @@ def create_note(note: NoteCreate, current_user: UserDB = Depends(get_current_use
     return new_note
 
 @app.get("/notes", response_model=List[Note])
-def get_notes(current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
-    notes = db.query(NoteDB).all()
-    result = [
-        note for note in notes
-        if not note.is_private or note.owner == current_user.username or current_user.role == Role.ADMIN.value
-    ]
-    return result
+def get_notes(current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
+    stmt = notes_stmt
+    if current_user.role != _ADMIN:
+        stmt = stmt.where(or_(NoteDB.is_private == False, NoteDB.owner == current_user.username))
+    return list_response(_notes_adapter, db.execute(stmt).all())
 
 @app.delete("/notes/{note_id}", response_model=Note)
-def delete_note(note_id: int, current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
+def delete_note(note_id: int, current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
     note = db.query(NoteDB).filter(NoteDB.id == note_id).first()
     if not note:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Note not found")
-    if note.owner != current_user.username and current_user.role != Role.ADMIN.value:
+    if note.owner != current_user.username and current_user.role != _ADMIN:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
     db.delete(note)
     db.commit()
     return note
 
 @app.put("/notes/{note_id}", response_model=Note)
-def update_note(note_id: int, note_update: NoteUpdate, current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
+def update_note(note_id: int, note_update: NoteUpdate, current_user: CurrentUser = Depends(get_current_user), db: Session = Depends(get_db)):
     note = db.query(NoteDB).filter(NoteDB.id == note_id).first()
     if not note:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Note not found")
-    if note.owner != current_user.username and current_user.role != Role.ADMIN.value:
+    if note.owner != current_user.username and current_user.role != _ADMIN:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
     update_data = note_update.dict(exclude_unset=True)
     for key, value in update_data.items():
@@ -304,62 +642,94 @@ def update_note(note_id: int, note_update: NoteUpdate, current_user: UserDB = De
     return note
 
 @app.get("/logs", response_model=List[Log])
-def get_logs(current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current_user.role != Role.ADMIN.value:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not enough permissions")
-    logs = db.query(LogDB).all()
-    return logs
+def get_logs(
+    before_id: Optional[int] = None,
+    limit: int = Query(LOGS_PAGE_SIZE, ge=1, le=LOGS_LIMIT),
+    current_user: CurrentUser = Depends(require_admin),
+    db: Session = Depends(get_db),
+):
+    # Keyset pagination: pass the smallest id of the previous page as before_id
+    stmt = logs_stmt
+    if before_id is not None:
+        stmt = stmt.where(LogDB.id < before_id)
+    logs = db.execute(stmt.limit(limit)).all()
+    return list_response(_logs_adapter, logs)
+
+def _export_logs():
+    # Owns its session: get_db's session is closed before a streamed body is sent
+    db = SessionLocal()
+    try:
+        for row in db.execute(logs_stmt.execution_options(yield_per=LOGS_EXPORT_CHUNK)):
+            yield Log.model_validate(row).model_dump_json() + "\n"
+    finally:
+        db.close()
+
+@app.get("/logs/export")
+def export_logs(current_user: CurrentUser = Depends(require_admin)):
+    return StreamingResponse(_export_logs(), media_type="application/x-ndjson")
 
 @app.put("/users/{user_id}/deactivate", response_model=User)
-def deactivate_user(user_id: int, current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current_user.role != Role.ADMIN.value:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
+def deactivate_user(user_id: int, current_user: CurrentUser = Depends(require_admin), db: Session = Depends(get_db)):
     user = db.query(UserDB).filter(UserDB.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     user.is_active = False
     db.commit()
+    invalidate_user_cache()
     db.refresh(user)
     return user
 
 @app.put("/users/{user_id}/reset_password", response_model=User)
-def reset_password(user_id: int, new_password: str, current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current_user.role != Role.ADMIN.value:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    user = db.query(UserDB).filter(UserDB.id == user_id).first()
+async def reset_password(user_id: int, new_password: str, current_user: CurrentUser = Depends(require_admin), db: Session = Depends(get_db)):
+    user = await run_in_threadpool(db.query(UserDB).filter(UserDB.id == user_id).first)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    user.hashed_password = get_password_hash(new_password)
-    db.commit()
-    db.refresh(user)
+    user.hashed_password = await run_password_hashing(get_password_hash, new_password)
+    await run_in_threadpool(_save_user, db, user)
+    invalidate_user_cache()
     return user
 
 @app.put("/users/{user_id}/update_role", response_model=User)
-def update_user_role(user_id: int, user_update_role: UserUpdateRole, current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current_user.role != Role.ADMIN.value:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
+def update_user_role(user_id: int, user_update_role: UserUpdateRole, current_user: CurrentUser = Depends(require_admin), db: Session = Depends(get_db)):
     user = db.query(UserDB).filter(UserDB.id == user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     user.role = user_update_role.role.value
     db.commit()
+    invalidate_user_cache()
     db.refresh(user)
     return user
 
-@app.get("/users", response_model=List[User])
-def get_all_users(current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current_user.role != Role.ADMIN.value:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    users = db.query(UserDB).all()
-    return users
+@app.get("/users", response_model=List[UserSummary])
+def get_all_users(current_user: CurrentUser = Depends(require_admin), db: Session = Depends(get_db)):
+    users = db.execute(users_stmt).all()
+    return list_response(_users_adapter, users)
 
 @app.delete("/users/{user_name}", response_model=User)
-def delete_user(user_name, current_user: UserDB = Depends(get_current_user), db: Session = Depends(get_db)):
-    if current_user.role != Role.ADMIN.value:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
+def delete_user(user_name, current_user: CurrentUser = Depends(require_admin), db: Session = Depends(get_db)):
     user = db.query(UserDB).filter(UserDB.username == user_name).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     db.delete(user)
     db.commit()
+    invalidate_user_cache()
     return user
+
+def _requires_auth(dependant) -> bool:
+    return any(dep.call is get_current_user or _requires_auth(dep) for dep in dependant.dependencies)
+
+def custom_openapi():
+    # Auth is resolved by a plain dependency, so the security schemes are added here
+    if app.openapi_schema:
+        return app.openapi_schema
+    schema = get_openapi(title=app.title, version=app.version, routes=app.routes)
+    schema.setdefault("components", {})["securitySchemes"] = SECURITY_SCHEMES
+    security = [{name: []} for name in SECURITY_SCHEMES]
+    for route in app.routes:
+        if isinstance(route, APIRoute) and _requires_auth(route.dependant):
+            for method in route.methods:
+                schema["paths"][route.path_format][method.lower()]["security"] = security
+    app.openapi_schema = schema
+    return schema
+
+app.openapi = custom_openapi